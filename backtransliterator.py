@@ -7,10 +7,18 @@ Created on Mon May 24 10:49:38 2021
 """
 
 import re
+from array import array
 from itertools import product
-from collections import namedtuple, defaultdict
-import iuliia
+from string import ascii_lowercase
+from collections import namedtuple, Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from heapq import nlargest
+from math import exp, log
+from iuliia import translate as iuliia_translate, WIKIPEDIA
+from types import MappingProxyType
 import pickle
+import sys
 
 
 eng2rus_dict = {"a": ["а"], "b": ["б"], "ch": ["ч"], "d": ["д"], "e": ["е", "э"], 
@@ -27,9 +35,19 @@ eng2rus_dict = {"a": ["а"], "b": ["б"], "ch": ["ч"], "d": ["д"], "e": ["е",
                 "z": ["з"], "zh": ["ж"], 
                 "ε": ["", "ь"]}
 
+VOWELS = frozenset('ёуеыаоэяию')
+CONSONANTS = frozenset('цкнгшщзхфвпрлджчсмтб')
+HARD_SOFT = frozenset('ъь')
+HARD_SOFT_Y = frozenset('ьъы')
+
 PositionalVariant = namedtuple('PositionalVariant', 'eng emits after before')
 
-translate = lambda source: iuliia.translate(source, schema=iuliia.WIKIPEDIA)
+# Maximal number of cached predictions of BackTransliterator
+CACHE_SIZE = 10_000
+
+@lru_cache(maxsize=200_000)
+def translate(source):
+    return iuliia_translate(source, schema=WIKIPEDIA)
 
 class BackTransliterator:
     def __init__(self):
@@ -47,10 +65,15 @@ class BackTransliterator:
 
         """
 
-        self.eng2rus_dict = eng2rus_dict
+        # All terms and emissions are interned, so equal strings in lookup
+        # keys are the same objects and compare by identity
+        self.eng2rus_dict = {sys.intern(e): [sys.intern(r) for r in emissions] 
+                             for e, emissions in eng2rus_dict.items()}
         self.single_elements = set(k for k in self.eng2rus_dict.keys() if len(self.eng2rus_dict[k]) == 1)
-        self.eng_split = re.compile(r'shch|[cskz]h|y[aoeui]|y|[aoeiu]|ts(?!h)|[skz](?!h)|[ngfvprldmtb]', 
-                                    re.IGNORECASE)
+        # Emission log-probabilities of terms with only one emission
+        self.certain = {e: {self.eng2rus_dict[e][0]: 0.0} for e in self.single_elements}
+        self._build_eng_split()
+        self._build_cand_table()
         
         # Since after Rus->Eng transliteration ь (soft-sign) between consonants
         # disappiar, it has to be inserted back during Eng->Rus back process.
@@ -62,9 +85,177 @@ class BackTransliterator:
         self.ab = set(product(a, b))
         self.c = {'b','v','d','zh','z','l','m','n','p','r','s','t','f','ch','sh','shch'}
         
+        # Least recently used predictions of repeated words, 
+        # reset with probabilities
+        self._predictions = OrderedDict()
+        
         # Probabilities
         self.probs = None
     
+    def _build_eng_split(self):
+        """
+        Builds DFA splitting transliterated word into english terms.
+        It splits the same way as regex
+        shch|[cskz]h|y[aoeui]|y|[aoeiu]|ts(?!h)|[skz](?!h)|[ngfvprldmtb]
+        States are prefixes of terms still waiting for the next symbol.
+        Each transition (state, symbol) -> (next state, emitted term or None,
+        whether the symbol is consumed). Not consumed symbol is processed
+        again from the next state.
+
+        Returns
+        -------
+        None.
+
+        """
+        terms = set(self.eng2rus_dict.keys()) - {'ε'}
+        prefixes = {t[:i] for t in terms for i in range(1, len(t))}
+        prefixes.add('ts') # ts before h is t-sh
+        states = [''] + sorted(prefixes)
+        state_id = {p: i for i, p in enumerate(states)}
+        
+        def flush(p):
+            # Longest term p starts with and the rest of p to process again
+            for i in range(len(p), 0, -1):
+                if p[:i] in terms:
+                    return sys.intern(p[:i]), p[i:]
+            # No term, skip the first symbol (e.g. lonely c)
+            return None, p[1:]
+        
+        self.eng_trans = {}
+        for p in states:
+            for s in ascii_lowercase:
+                if p + s in state_id:
+                    t = (state_id[p + s], None, True)
+                elif p + s in terms:
+                    t = (0, sys.intern(p + s), True)
+                elif p + s == 'tsh':
+                    t = (state_id['s'], 't', False)
+                else:
+                    continue
+                self.eng_trans[state_id[p], s] = t
+                self.eng_trans[state_id[p], s.upper()] = t
+        
+        # Any other symbol is skipped in the initial state and flushes 
+        # pending term otherwise
+        self.eng_fallback = [(0, None, True)]
+        self.eng_final = [()]
+        for p in states[1:]:
+            term, rest = flush(p)
+            self.eng_fallback.append((state_id[rest], term, False))
+            final = []
+            while p:
+                term, p = flush(p)
+                if term is not None:
+                    final.append(term)
+            self.eng_final.append(tuple(final))
+    
+    def _build_cand_table(self):
+        """
+        Precomputes emission rules for every english term.
+        cand_table[e][first][last][context] lists (emission, next context)
+        possible for term e at the first and/or the last position of word
+        after a partial variant with given context, so enumeration does not
+        check any rules.
+        Context of a partial variant is a bitmask: 1 - ends with a vowel,
+        2 - ends with a consonant, 4 - ends with ye -> е after a consonant.
+        Emission is not possible if context & forbidden is not 0.
+
+        Returns
+        -------
+        None.
+
+        """
+        self.cand_table = {}
+        for e, emissions in self.eng2rus_dict.items():
+            table = [[[[] for context in range(8)] for last in (0, 1)] for first in (0, 1)]
+            for first, last in product((0, 1), repeat=2):
+                for c in emissions:
+                    # ъ/ь cannot be in the beginning
+                    if first and c != '' and c[0] in HARD_SOFT:
+                        continue
+                    
+                    # й cannot be in the beginning
+                    if first and c == 'й':
+                        continue
+                    
+                    # y -> ий/ый can be only in the end of the world
+                    if (c == 'ий' or c == 'ый') and not last:
+                        continue
+                    
+                    forbidden = 0
+                    # ъ/ь/ы cannot be after a vowel
+                    if c != '' and c[0] in HARD_SOFT_Y:
+                        forbidden |= 1
+                    
+                    # й cannot be after a consonant
+                    if c == 'й':
+                        forbidden |= 2
+                    
+                    # йо, йя... cannot be after a consonant in the last pos
+                    if last and c != '' and c[0] == 'й':
+                        forbidden |= 2
+                    
+                    # ye -> cannot be after a consonant before the end
+                    ye_e = c == 'е' and e == 'ye'
+                    if last and ye_e:
+                        forbidden |= 2
+                    
+                    # ye -> е cannot be between two consonants
+                    if c != '' and c[0] in CONSONANTS:
+                        forbidden |= 4
+                    
+                    next_context = 0
+                    if c != '' and c[-1] in VOWELS:
+                        next_context |= 1
+                    if c != '' and c[-1] in CONSONANTS:
+                        next_context |= 2
+                    
+                    for context in range(8):
+                        if context & forbidden:
+                            continue
+                        if ye_e and context & 2:
+                            table[first][last][context].append((c, next_context | 4))
+                        else:
+                            table[first][last][context].append((c, next_context))
+            self.cand_table[e] = table
+    
+    def _split(self, word):
+        """
+        Splits transliterated word into english terms and inserts ε.
+
+        Parameters
+        ----------
+        word : str
+            Transliterated word.
+
+        Returns
+        -------
+        splitted : tuple of str
+            Splitted form of word with ε in all possible positions.
+        """
+        trans = self.eng_trans
+        fallback = self.eng_fallback
+        ab = self.ab
+        splitted = []
+        state = 0
+        i, n = 0, len(word)
+        while i < n:
+            state, term, consumed = trans.get((state, word[i])) or fallback[state]
+            if term is not None:
+                # ε between pairs from a & b is emitted along with the term
+                if splitted and (splitted[-1], term) in ab:
+                    splitted.append('ε')
+                splitted.append(term)
+            if consumed:
+                i += 1
+        for term in self.eng_final[state]:
+            if splitted and (splitted[-1], term) in ab:
+                splitted.append('ε')
+            splitted.append(term)
+        if splitted[-1] in self.c:
+            splitted.append('ε')
+        return tuple(splitted)
+    
     def _list_all(self, word):
         """
         Lists all possible back transliterations as well as splitted form.
@@ -76,67 +267,61 @@ class BackTransliterator:
 
         Returns
         -------
-        splitted : list of str
+        splitted : tuple of str
             Splitted form of word.
-        res : list of lists of str
-            All possible transliterations
+        res : tuple of pairs (tuple of str, str)
+            All possible transliterations as emissions and joined string
         """
-        splitted = self.eng_split.findall(word)
-        
-        # Find possible positions for ε and insert
-        possible_eps = []
-        for i in range(1, len(splitted)):
-            if (splitted[i-1], splitted[i]) in self.ab:
-                possible_eps.append(i)
-        if splitted[-1] in self.c:
-            possible_eps.append(len(splitted))
-        for shift, pos in enumerate(possible_eps):
-            splitted.insert(pos + shift, 'ε')
+        splitted = self._split(word)
+
+        # Extend partial variants term by term, dropping prefixes which
+        # break the rules as soon as possible. Restored string is extended
+        # along with emissions, so it does not have to be joined afterwards
+        res = [((), '', 0)]
+        L = len(splitted)
+        for i, e in enumerate(splitted):
+            candidates = self.cand_table[e][i == 0][i == L - 1]
+            res = [(variant + (c,), restored + c, next_context) 
+                   for variant, restored, context in res 
+                   for c, next_context in candidates[context]]
+        res = [(variant, restored) for variant, restored, _ in res]
+        return splitted, tuple(res)
+    
+    def _align(self, splitted, word):
+        """
+        Finds emissions of splitted terms restoring the original word.
+        Walks the word left to right trying emissions in the same order
+        and by the same rules as _list_all, backtracking on mismatch.
 
-        vowels = 'ёуеыаоэяию'
-        consonants = 'цкнгшщзхфвпрлджчсмтб'
+        Parameters
+        ----------
+        splitted : tuple of str
+            Splitted form of transliterated word.
+        word : str
+            Original word.
 
-        res = []
+        Returns
+        -------
+        tuple of str or None
+            The first variant listed by _list_all restoring word,
+            None if there is no such variant.
+        """
         L = len(splitted)
-        for variant in product(*[self.eng2rus_dict[i] for i in splitted]):
-            for i, c in enumerate(variant):
-                # ъ/ь cannot be in the beginning
-                if i == 0 and c[0] in 'ъь':
-                    break
-                
-                # ъ/ь/ы cannot be after a vowel
-                if i > 0 and c != '' and c[0] in 'ьъы' and variant[i-1][-1] in vowels:
-                    break
-                
-                # й cannot be after a consonant
-                if i > 0 and c == 'й' and variant[i-1][-1] in consonants:
-                    break
-                
-                # йо, йя... cannot be after a consonant in the last pos
-                if i == L - 1 and c != '' and c[0] == 'й' and variant[i-1][-1] in consonants:
-                    break
-                
-                # й cannot be in the beginning
-                if i == 0 and c == 'й':
-                    break
-                
-                # y -> ий/ый can be only in the end of the world
-                if (c == 'ий' or c == 'ый') and i != L - 1:
-                    break
-                
-                # ye -> е cannot be between two consonants
-                if c == 'е' and splitted[i] == 'ye' and i > 0 and i < L-1 and \
-                    (variant[i-1][-1] in consonants and variant[i+1][0] in consonants):
-                    break
-                
-                # ye -> cannot be after a consonant before the end
-                if i == L - 1 and c == 'е' and splitted[i] == 'ye' and variant[i-1][-1] in consonants:
-                    break
-            else:
-                res.append(variant)
-        return splitted, res
+        
+        def walk(i, pos, context):
+            if i == L:
+                return () if pos == len(word) else None
+            for c, next_context in self.cand_table[splitted[i]][i == 0][i == L - 1][context]:
+                if not word.startswith(c, pos):
+                    continue
+                rest = walk(i + 1, pos + len(c), next_context)
+                if rest is not None:
+                    return (c,) + rest
+            return None
+        
+        return walk(0, 0, 0)
 
-    def predict_proba(self, word):
+    def predict_proba(self, word, k=None):
         """
         Gets predicted back transliterations with probabilities of each.
 
@@ -144,38 +329,87 @@ class BackTransliterator:
         ----------
         word : str
             Transliterated word.
+        k : int, optional
+            Number of the most probable back transliterations to return.
+            All are returned if None. The default is None.
 
         Returns
         -------
         res : list of pairs (float, str)
-            All possible back transliterations with probabilities sorted from
-            the most probable to the least one.
+            All possible back transliterations, or the k most probable ones
+            if k is given, with probabilities sorted from the most probable
+            to the least one.
+
+        """
+        predictions = self._predictions
+        if (word, k) in predictions:
+            predictions.move_to_end((word, k))
+            return list(predictions[(word, k)])
+        res = self._predict_proba(word, k)
+        predictions[(word, k)] = res
+        if len(predictions) > CACHE_SIZE:
+            predictions.popitem(last=False)
+        return list(res)
+    
+    def _predict_proba(self, word, k=None):
+        """
+        predict_proba without cache.
+        Variants are scored by sums of log-probabilities, so probabilities
+        of long words do not underflow to 0 before sorting.
+
+        Parameters
+        ----------
+        word : str
+            Transliterated word.
+        k : int, optional
+            Number of the most probable back transliterations to return.
+
+        Returns
+        -------
+        tuple of pairs (float, str)
+            Same as predict_proba.
 
         """
         splitted, all_possibilities = self._list_all(word)
         res = []
         L = len(splitted)
-        for possibility in all_possibilities:
-            restored = ''.join(possibility)
-            if self.probs is None:
-                prob = 1/L
+        prob_table = self.prob_table
+        if prob_table is not None:
+            # Probability of an emission depends only on adjacent terms, so
+            # emissions of a position are looked up by one context key
+            tables = []
+            for i, e in enumerate(splitted):
+                if e in self.single_elements:
+                    tables.append(self.certain[e])
+                    continue
+                # ^ and $ are symbols for begin and end of the word
+                after = splitted[i-1] if i > 0 else '^'
+                before = splitted[i+1] if i < L-1 else '$'
+                tables.append(prob_table.get((after, e, before), {}))
+        for possibility, restored in all_possibilities:
+            if prob_table is None:
+                res.append((1/L, restored))
+                continue
+            logp = 0
+            for table, r in zip(tables, possibility):
+                lp = table.get(r)
+                if lp is None:
+                    # unseen positional variant has zero probability,
+                    # list only variants with non-zero probability
+                    break
+                logp += lp
             else:
-                prob = 1
-                for i, (e, r) in enumerate(zip(splitted, possibility)):
-                    # ^ and $ are symbols for begin and end of the word
-                    pv = PositionalVariant(eng=e, emits=r, 
-                                           after=splitted[i-1] if i > 0 else '^', 
-                                           before=splitted[i+1] if i < L-1 else '$')
-                    prob *= self._probability(pv)
-            
-            if prob > 0:
-                # list only varianst with non-zero probability
-                res.append((prob, restored))
+                res.append((logp, restored))
         
-        res.sort(reverse=True)
-        return res
+        if k is None:
+            res.sort(reverse=True)
+        else:
+            res = nlargest(k, res)
+        if prob_table is None:
+            return tuple(res)
+        return tuple((exp(logp), restored) for logp, restored in res)
     
-    def predict(self, word):
+    def predict(self, word, k=None):
         """
         Returns all possible back transliterations.
 
@@ -183,14 +417,18 @@ class BackTransliterator:
         ----------
         word : str
             Transliterated word.
+        k : int, optional
+            Number of the most probable back transliterations to return.
+            All are returned if None. The default is None.
 
         Returns
         -------
         list of str
-            List of all possible back transliterations sorted by probabilities.
+            List of all possible back transliterations, or the k most
+            probable ones if k is given, sorted by probabilities.
 
         """
-        pp = self.predict_proba(word)
+        pp = self.predict_proba(word, k)
         return [p[1] for p in pp]
         
     def fit(self, words):
@@ -208,58 +446,77 @@ class BackTransliterator:
         None.
 
         """
-        self.probs = defaultdict(int)
-        count = defaultdict(int)
+        emitted = Counter()
+        count = Counter()
+        local_translate = translate
+        # Different words often share transliteration, so splits are reused
+        splits = {}
         
         # For all word count possible combinations of english terms e1-e2-e3
         # and possible emission variants for e2 depending on adjacent e1-e3
         for word in words:
-            translated = translate(word)
-            splitted, all_possibilities = self._list_all(translated)
+            translated = local_translate(word)
+            splitted = splits.get(translated)
+            if splitted is None:
+                splitted = splits[translated] = self._split(translated)
+            possibility = self._align(splitted, word)
+            if possibility is None:
+                continue
             L = len(splitted)
-            for possibility in all_possibilities:
-                restored = ''.join(possibility)
-                if restored == word:
-                    for i, (e, r) in enumerate(zip(splitted, possibility)):
-                        if e in self.single_elements:
-                            continue
-                        pv = PositionalVariant(eng=e, emits=r, 
-                                               after=splitted[i-1] if i > 0 else '^', 
-                                               before=splitted[i+1] if i < L-1 else '$')
-                        self.probs[pv] += 1
-                        count[(pv.after, pv.eng, pv.before)] += 1
-                    break
-
-        # Normalization
-        for k, v in self.probs.items():
-            pv = PositionalVariant(*k)
-            self.probs[k] = v / count[(pv.after, pv.eng, pv.before)]
+            for i, (e, r) in enumerate(zip(splitted, possibility)):
+                if e in self.single_elements:
+                    continue
+                after = splitted[i-1] if i > 0 else '^'
+                before = splitted[i+1] if i < L-1 else '$'
+                emitted[(e, r, after, before)] += 1
+                count[(after, e, before)] += 1
+
+        # Normalization, keys are plain tuples in PositionalVariant order
+        self.probs = {(e, r, after, before): v / count[(after, e, before)] 
+                      for (e, r, after, before), v in emitted.items()}
                 
-    def _probability(self, pv):
+    @property
+    def probs(self):
         """
-        Returns probability of a particular positional variant.
+        Probabilities of positional variants, None if not fitted.
+        Keys are (eng, emits, after, before) tuples equal to PositionalVariant.
+        The mapping is read-only, only assigning new probabilities updates
+        prob_table and resets cached predictions.
+        """
+        if self._probs is None:
+            return None
+        return MappingProxyType(self._probs)
+    
+    @probs.setter
+    def probs(self, probs):
+        self._probs = None if probs is None else dict(probs)
+        self._update_probs()
 
-        Parameters
-        ----------
-        pv : tuple (eng emits after before)
-            tuple describing a positional variant.
+    def _update_probs(self):
+        """
+        Groups probabilities by context after changing them.
+        prob_table[(after, eng, before)] maps emits to log-probability.
 
         Returns
         -------
-        float
-            1 for elements that have only one possible emission.
-            probability depending on given positional variant.
-            0 if given positional variant was not found in pretrained probabilities.
-        """
-        if pv.eng in self.single_elements:
-            return 1
-        
-        return self.probs.get(pv, 0)
+        None.
 
+        """
+        self._predictions.clear()
+        if self._probs is None:
+            self.prob_table = None
+            return
+        self.prob_table = {}
+        for (e, r, after, before), p in self._probs.items():
+            if p > 0:
+                self.prob_table.setdefault((after, e, before), {})[r] = log(p)
 
     def save_probs(self, name):
         """
-        Save trained probabilities
+        Save trained probabilities.
+        Probabilities are stored by columns: tuple of eng, emits, after and
+        before lists and array of floats, so loading does not rebuild
+        PositionalVariant for every key. Not fitted model is saved as None.
 
         Parameters
         ----------
@@ -271,8 +528,13 @@ class BackTransliterator:
         None.
 
         """
+        if self.probs is None:
+            probs = None
+        else:
+            columns = tuple(list(column) for column in zip(*self.probs.keys())) or ([], [], [], [])
+            probs = (columns, array('d', self.probs.values()))
         with open(f'{name}.pickle', 'wb') as fo:
-            pickle.dump(self.probs, fo)
+            pickle.dump(probs, fo, protocol=pickle.HIGHEST_PROTOCOL)
     
     def load_probs(self, name):
         """
@@ -289,29 +551,72 @@ class BackTransliterator:
 
         """
         with open(f'{name}.pickle', 'rb') as fi:
-            self.probs = pickle.load(fi)
+            probs = pickle.load(fi)
+        if probs is None:
+            self.probs = None
+        elif isinstance(probs, dict):
+            # Old models are pickled dicts of PositionalVariant
+            self.probs = {tuple(map(sys.intern, k)): v for k, v in probs.items()}
+        else:
+            columns, values = probs
+            columns = [map(sys.intern, column) for column in columns]
+            self.probs = dict(zip(zip(*columns), values))
         
 
-data = set()
-with open('/home/kirill/sources/python/wordpaths/lop_list.txt', 'r') as fi:
-    for line in fi:
-        l = line.strip().lower()
-        dirty_symbols = set(l) - set('ёйцукенгшщзхъфывапролджэячсмитьбю')
-        if len(dirty_symbols) == 0:
-            data.add(l)
-
-bt = BackTransliterator()
-bt.load_probs('lop')
-
-m, n = 0, 0
-k = 0
-for word in data:
-    translated = translate(word)
-    x = bt.predict(translated)
+def _init_worker(name):
+    """
+    Loads model into a worker process.
+
+    Parameters
+    ----------
+    name : str
+        Name of model.
+
+    Returns
+    -------
+    None.
+
+    """
+    global bt
+    bt = BackTransliterator()
+    bt.load_probs(name)
+
+
+def _rank(word):
+    """
+    Checks if the word is restored by back transliteration of itself.
+
+    Parameters
+    ----------
+    word : str
+        Original word.
+
+    Returns
+    -------
+    int or None
+        0 if the word is the most probable back transliteration,
+        1 if it is the second one, None otherwise.
+
+    """
+    # Every word is checked once, so predictions are not cached
+    x = [p[1] for p in bt._predict_proba(translate(word), 2)]
     if x[0] == word:
-        m += 1
+        return 0
     elif x[1] == word:
-        k += 1
-    n += 1
+        return 1
+
+
+if __name__ == '__main__':
+    # Only non-empty words of russian letters are used
+    clean_word = re.compile('[ёйцукенгшщзхъфывапролджэячсмитьбю]+')
+
+    with open('/home/kirill/sources/python/wordpaths/lop_list.txt', 'r') as fi:
+        data = {l for l in map(str.strip, fi.read().lower().split('\n')) 
+                if clean_word.fullmatch(l)}
+
+    # Words are checked independently, so they are spread over processes
+    with ProcessPoolExecutor(initializer=_init_worker, initargs=('lop',)) as ex:
+        ranks = Counter(ex.map(_rank, data, chunksize=256))
+    m, k, n = ranks[0], ranks[1], len(data)
 
 # [\d()-]
\ No newline at end of file
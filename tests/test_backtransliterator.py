@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests against results of the original regex and cartesian
+product implementation.
+"""
+
+import copy
+import pickle
+import re
+
+import pytest
+
+from backtransliterator import BackTransliterator, PositionalVariant
+
+
+@pytest.fixture
+def bt():
+    return BackTransliterator()
+
+
+@pytest.mark.parametrize('word, splitted', [
+    ('shchuka', ['shch', 'u', 'k', 'a']),
+    # ts before h is t-sh, ε between a & b pairs and after c at the end
+    ('vtsherkov', ['v', 't', 'ε', 'sh', 'e', 'r', 'ε', 'k', 'o', 'v', 'ε']),
+    ('otets', ['o', 't', 'e', 'ts']),
+    ('yel', ['ye', 'l', 'ε']),
+    ('podyezd', ['p', 'o', 'd', 'ye', 'z', 'ε', 'd', 'ε']),
+    ('malenky', ['m', 'a', 'l', 'e', 'n', 'ε', 'k', 'y']),
+    ('bolshoy', ['b', 'o', 'l', 'ε', 'sh', 'o', 'y']),
+    ('myod', ['m', 'yo', 'd', 'ε']),
+    ('noch', ['n', 'o', 'ch', 'ε']),
+    # lonely c and symbols which are not terms are skipped
+    ('cwash-c', ['a', 'sh', 'ε']),
+])
+def test_split(bt, word, splitted):
+    assert list(bt._split(word)) == splitted
+
+
+def test_split_as_regex(bt):
+    eng_split = re.compile(r'shch|[cskz]h|y[aoeui]|y|[aoeiu]|ts(?!h)|[skz](?!h)|[ngfvprldmtb]')
+    for word in ['shchshcshtshtssyyaychckhzzhkh', 'tstshtsch', 'shcxshc', 
+                 'yyoyuyey', 'sz kztsk', 'abcdefghijklmnopqrstuvwxyz']:
+        assert [t for t in bt._split(word) if t != 'ε'] == eng_split.findall(word)
+
+
+def test_predictions_cache(bt):
+    uniform = bt.predict_proba('yel')
+    bt.predict_proba('yel').clear()
+    assert bt.predict_proba('yel') == uniform
+    
+    # Copies have own caches
+    copied = copy.deepcopy(pickle.loads(pickle.dumps(bt)))
+    copied.fit(['ель'])
+    assert copied.predict_proba('yel') == [(1.0, 'ель')]
+    assert bt.predict_proba('yel') == uniform
+
+
+@pytest.mark.parametrize('word, splitted, restored', [
+    ('shchuka', ['shch', 'u', 'k', 'a'], ['щука', 'шчука']),
+    ('otets', ['o', 't', 'e', 'ts'], 
+     ['отец', 'отетс', 'отетьс', 'отэц', 'отэтс', 'отэтьс']),
+    ('yel', ['ye', 'l', 'ε'], ['ел', 'ель', 'йел', 'йель', 'ыел', 'ыель']),
+    ('podyezd', ['p', 'o', 'd', 'ye', 'z', 'ε', 'd', 'ε'], 
+     ['подьезд', 'подьездь', 'подьезьд', 'подьезьдь', 'подйезд', 
+      'подйездь', 'подйезьд', 'подйезьдь', 'подъезд', 'подъездь', 
+      'подъезьд', 'подъезьдь', 'подыезд', 'подыездь', 'подыезьд', 
+      'подыезьдь', 'подьэзд', 'подьэздь', 'подьэзьд', 'подьэзьдь']),
+    ('malenky', ['m', 'a', 'l', 'e', 'n', 'ε', 'k', 'y'], 
+     ['маленкы', 'маленкый', 'маленкий', 'маленькы', 'маленькый', 
+      'маленький', 'малэнкы', 'малэнкый', 'малэнкий', 'малэнькы', 
+      'малэнькый', 'малэнький']),
+    ('bolshoy', ['b', 'o', 'l', 'ε', 'sh', 'o', 'y'], 
+     ['болшой', 'болшоий', 'большой', 'большоий']),
+    ('semya', ['s', 'e', 'm', 'ya'], 
+     ['семя', 'семья', 'семъя', 'семьа', 'сэмя', 'сэмья', 'сэмъя', 'сэмьа']),
+    ('myod', ['m', 'yo', 'd', 'ε'], 
+     ['мёд', 'мёдь', 'мьёд', 'мьёдь', 'мъёд', 'мъёдь', 'мйод', 'мйодь', 
+      'мьод', 'мьодь', 'мыод', 'мыодь']),
+])
+def test_list_all(bt, word, splitted, restored):
+    res_splitted, res = bt._list_all(word)
+    assert list(res_splitted) == splitted
+    assert [r for _, r in res] == restored
+    assert all(''.join(variant) == r for variant, r in res)
+
+
+def test_align_is_first_listed_variant(bt):
+    for word in ['yel', 'podyezd', 'malenky', 'semya', 'myod']:
+        splitted, res = bt._list_all(word)
+        for _, restored in res:
+            first = next(v for v, r in res if r == restored)
+            assert bt._align(splitted, restored) == first
+        assert bt._align(splitted, 'нет') is None
+
+
+def test_fit(bt):
+    bt.fit(['ель', 'ел', 'семья', 'семя', 'съезд', 'маленький', 'конь', 
+            'ночь', 'отец', 'большой', 'синий', 'подъезд', 'мёд', 'объём'])
+    assert bt.probs == {
+        ('e', 'е', 'l', 'n'): 1.0,
+        ('e', 'е', 's', 'm'): 1.0,
+        ('e', 'е', 't', 'ts'): 1.0,
+        ('ts', 'ц', 'e', '$'): 1.0,
+        ('y', 'ий', 'k', '$'): 1.0,
+        ('y', 'ий', 'n', '$'): 1.0,
+        ('y', 'й', 'o', '$'): 1.0,
+        ('ya', 'ья', 'm', '$'): 0.5,
+        ('ya', 'я', 'm', '$'): 0.5,
+        ('ye', 'е', '^', 'l'): 1.0,
+        ('ye', 'ъе', 'd', 'z'): 1.0,
+        ('ye', 'ъе', 's', 'z'): 1.0,
+        ('yo', 'ъё', 'b', 'm'): 1.0,
+        ('yo', 'ё', 'm', 'd'): 1.0,
+        ('ε', '', 'd', '$'): 1.0,
+        ('ε', '', 'l', '$'): 0.5,
+        ('ε', '', 'm', '$'): 1.0,
+        ('ε', '', 'z', 'd'): 1.0,
+        ('ε', 'ь', 'ch', '$'): 1.0,
+        ('ε', 'ь', 'l', '$'): 0.5,
+        ('ε', 'ь', 'l', 'sh'): 1.0,
+        ('ε', 'ь', 'n', '$'): 1.0,
+        ('ε', 'ь', 'n', 'k'): 1.0,
+    }
+    assert bt.predict_proba('yel') == [(0.5, 'ель'), (0.5, 'ел')]
+    assert bt.predict_proba('semya') == [(0.5, 'семя'), (0.5, 'семья')]
+    assert bt.predict_proba('malenky') == [(1.0, 'маленький')]
+    assert bt.predict_proba('sinyaya') == []
+
+
+def test_unfitted_probabilities(bt):
+    assert bt.predict_proba('noch') == [(0.25, 'ночь'), (0.25, 'ноч')]
+
+
+def test_assign_probs(bt):
+    assert len(bt.predict_proba('yel')) == 6
+    # Assigning probabilities resets cached predictions
+    bt.probs = {('ye', 'е', '^', 'l'): 0.5, ('ε', '', 'l', '$'): 1.0}
+    assert bt.predict_proba('yel') == [(0.5, 'ел')]
+    with pytest.raises(TypeError):
+        bt.probs[('ye', 'ье', '^', 'l')] = 0.5
+    bt.probs = None
+    assert len(bt.predict_proba('yel')) == 6
+
+
+@pytest.mark.parametrize('fitted', [False, True])
+@pytest.mark.parametrize('k', [0, 1, 2, 5])
+def test_top_k(bt, fitted, k):
+    if fitted:
+        bt.fit(['ель', 'ел', 'семья', 'семя', 'подъезд', 'маленький', 'мёд'])
+    for word in ['yel', 'semya', 'podyezd', 'malenky', 'myod', 'otets']:
+        assert bt.predict_proba(word, k) == bt.predict_proba(word)[:k]
+        assert bt.predict(word, k) == bt.predict(word)[:k]
+    assert bt.predict_proba('yel', 0) == []
+
+
+def test_long_word_does_not_underflow(bt):
+    # Products of these probabilities are 0.0 in floats, sums of logs are not
+    bt.probs = {('ye', 'е', '^', 'ye'): 1e-200, ('ye', 'е', 'ye', 'ye'): 1e-200, 
+                ('ye', 'е', 'ye', '$'): 1e-200, ('ye', 'йе', 'ye', '$'): 1e-250}
+    assert bt.predict('yeyeye') == ['еее', 'еейе']
+    assert bt.predict('yeyeye', 1) == ['еее']
+
+
+@pytest.mark.parametrize('probs', [
+    {('ye', 'е', '^', 'l'): 0.25, ('ε', 'ь', 'l', '$'): 1.0},
+    {},
+    None,
+])
+def test_save_load_probs(bt, tmp_path, probs):
+    bt.probs = probs
+    bt.save_probs(tmp_path / 'model')
+    loaded = BackTransliterator()
+    loaded.load_probs(tmp_path / 'model')
+    assert loaded.probs == probs
+
+
+def test_load_legacy_probs(bt, tmp_path):
+    # Old models are pickled dicts of PositionalVariant
+    probs = {PositionalVariant('ye', 'е', '^', 'l'): 0.25,
+             PositionalVariant('ε', '', 'l', '$'): 1.0}
+    with open(tmp_path / 'model.pickle', 'wb') as fo:
+        pickle.dump(probs, fo)
+    bt.load_probs(tmp_path / 'model')
+    assert bt.probs == {('ye', 'е', '^', 'l'): 0.25, ('ε', '', 'l', '$'): 1.0}
+    assert bt.predict_proba('yel') == [(0.25, 'ел')]